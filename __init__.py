@@ -1,38 +1,158 @@
 
-
 __version__ = '0.1'
 
-__all__ = ('NutsException', )
+__all__ = ('NutException', 'EtreeBackend', 'get_backend', 'set_backend')
+
+
+import copy
+import os
+import threading
 
 
 class NutException(Exception):
     pass
 
 
-# Try to import some version of etree.
-try:
-    from lxml import etree
-    # running with lxml.etree
-except ImportError:
-    try:
-        # Python 2.5
-        import xml.etree.cElementTree as etree
-        # running with cElementTree on Python 2.5+
-    except ImportError:
-        try:
-            # Python 2.5
-            import xml.etree.ElementTree as etree
-            # "running with ElementTree on Python 2.5+
-        except ImportError:
+BACKEND_ENV = 'NUTS_ETREE_BACKEND'
+'''
+Environment variable choosing the XML library: 'lxml', 'etree' (the standard
+library's :mod:`xml.etree.ElementTree`) or 'auto' (lxml if it is installed,
+else ElementTree).  :func:`set_backend` overrides it.
+'''
+
+
+class EtreeBackend(object):
+    """
+    One XML library, and the operations Nuts uses from it.  Code which needs
+    a library-specific fast path checks :attr:`is_lxml` or the optional
+    attributes (e.g. :attr:`xmlfile`) here instead of assuming a library.
+    """
+
+    def __init__(self, name, module):
+        self.name = name
+        '''
+        'lxml' or 'etree'.
+        '''
+
+        self.etree = module
+        '''
+        The etree module itself.
+        '''
+
+        self.is_lxml = name == 'lxml'
+
+        self.Element = module.Element
+        self.SubElement = module.SubElement
+        self.ElementTree = module.ElementTree
+        self.fromstring = module.fromstring
+        self.tostring = module.tostring
+        self.parse = module.parse
+        self.iterparse = module.iterparse
+        self.XMLParser = module.XMLParser
+
+        self.xmlfile = getattr(module, 'xmlfile', None)
+        '''
+        lxml's incremental writer, None with ElementTree.
+        '''
+
+        self.default_write_kwargs = {'pretty_print': True} \
+            if self.is_lxml else {}
+        '''
+        kwargs :func:`~acorn.Acorn.toxml` passes to :func:`write` by default.
+        '''
+
+    def reusable(self, el, dest):
+        """
+        Returns **el**, ready to be appended to **dest**.  ElementTree
+        elements can be in several trees at once, so this is **el** itself.
+        An lxml element can only be in one place: if **el** is already in
+        the same tree as **dest** a deep copy is returned, otherwise **el**
+        itself, which appending then takes out of the tree it is in.
+        """
+        if self.is_lxml and el.getparent() is not None and \
+                el.getroottree().getroot() is dest.getroottree().getroot():
+            return copy.deepcopy(el)
+        return el
+
+    def write(self, tree, file, **write_kwargs):
+        """
+        Writes **tree** to **file** (a path or binary file).  With
+        ElementTree, 'pretty_print' is emulated by indenting a copy of the
+        tree, leaving **tree** itself as it was.
+        """
+        if not self.is_lxml and write_kwargs.pop('pretty_print', False):
+            tree = self.ElementTree(copy.deepcopy(tree.getroot()))
+            self.etree.indent(tree)
+        tree.write(file, **write_kwargs)
+
+
+_choice = None
+_backend = None
+_lock = threading.Lock()
+
+
+def set_backend(name):
+    """
+    Chooses the XML library by **name**: 'lxml', 'etree' or 'auto' (None
+    means the same as 'auto').  The library is imported the first time it is
+    needed.
+
+    Elements made by one library can't be mixed with the other's, so choose
+    before loading or saving anything.
+    """
+    global _choice, _backend
+
+    if name not in (None, 'auto', 'lxml', 'etree'):
+        raise NutException("Unknown etree backend \"{}\"".format(name))
+
+    with _lock:
+        _choice = name
+        _backend = None
+
+
+def get_backend():
+    """
+    Returns the :class:`EtreeBackend` in use, importing the library on the
+    first call.
+    """
+    backend = _backend
+    if backend is None:
+        backend = _load_backend()
+    return backend
+
+
+def _load_backend():
+    global _backend
+
+    with _lock:
+        if _backend is not None:
+            return _backend
+
+        name = _choice or os.environ.get(BACKEND_ENV) or 'auto'
+
+        if name in ('auto', 'lxml'):
             try:
-                # normal cElementTree install
-                import cElementTree as etree
-                # running with cElementTree"
+                from lxml import etree
             except ImportError:
-                try:
-                    # normal ElementTree install
-                    import elementtree.ElementTree as etree
-                    # running with ElementTree
-                except ImportError:
-                    raise Exception(
-                        "Failed to import ElementTree from any known place")
+                if name == 'lxml':
+                    raise NutException("The lxml backend requires lxml")
+            else:
+                _backend = EtreeBackend('lxml', etree)
+                return _backend
+
+        if name not in ('auto', 'etree'):
+            raise NutException((
+                "Unknown etree backend \"{}\" in {}").format(
+                    name, BACKEND_ENV))
+
+        import xml.etree.ElementTree as etree
+        _backend = EtreeBackend('etree', etree)
+        return _backend
+
+
+def __getattr__(name):
+    # 'etree' used to be imported here eagerly, keep it available.
+    if name == 'etree':
+        return get_backend().etree
+    raise AttributeError(
+        "module {!r} has no attribute {!r}".format(__name__, name))
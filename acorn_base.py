@@ -10,21 +10,236 @@ It is possible to create custom sources.
 """
 
 
-from __init__ import etree, NutException
+from collections import namedtuple
+from contextlib import contextmanager
+from functools import partial
+import threading
+from types import MappingProxyType
+
+from __init__ import get_backend, NutException
+
+
+_MISSING = object()
+
+# NumPy, imported when first needed, None if it isn't installed.
+_numpy = _MISSING
+
+
+def _import_numpy():
+    global _numpy
+    if _numpy is _MISSING:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy = numpy
+    return _numpy
 
 
 class AcornException(NutException):
     pass
 
 
+class AcornBatchError(AcornException):
+    """
+    Raised by :func:`~acorn.Acorn.toxml_many` once the whole batch has run,
+    if any item failed.
+    """
+
+    def __init__(self, results, failures):
+        super(AcornBatchError, self).__init__((
+            "{} of {} items failed, the first with: {!r}").format(
+                len(failures), len(results), failures[0][1]))
+
+        self.results = results
+        '''
+        The result of every item, in order, None for those which failed.
+        '''
+
+        self.failures = failures
+        '''
+        List of ``(index, exception)`` for the items which failed.
+        '''
+
+
+AcornChange = namedtuple('AcornChange', 'obj name kind value')
+AcornChange.__doc__ = """
+One change made by :func:`~acorn.Acorn.update_fromxml`: attribute *name* of
+*obj* changed.  *kind* is one of:
+
+- 'set' - the attribute was set to *value*
+- 'deleted' - the attribute was deleted (an optional child disappeared)
+- 'added' - *value* was added to a 'children' list
+- 'removed' - *value* was removed from a 'children' list
+- 'reordered' - the objects kept in a 'children' list changed order
+"""
+
+
+class AcornChangeLog(object):
+    """
+    Collects the changes made by :func:`~acorn.Acorn.update_fromxml`.
+    Sources report their changes with :func:`record`.
+    """
+
+    def __init__(self):
+        self.changes = []
+        self._touched = set()
+
+    def record(self, obj, name, kind, value=None):
+        self.changes.append(AcornChange(obj, name, kind, value))
+        self._touched.add(id(obj))
+
+    def touched(self, obj):
+        """
+        Returns True if a change was recorded for **obj**.
+        """
+        return id(obj) in self._touched
+
+
+class AcornLoadContext(object):
+    """
+    State shared by everything loaded in one :func:`~acorn.Acorn.fromxml`
+    (or :func:`~acorn.Acorn.update_fromxml`) pass, including any fromxml
+    calls made while it runs.  At the moment this is the index of objects by
+    id used by the 'ref' source (see :class:`AcornRefSource`).
+    """
+
+    _local = threading.local()
+
+    def __init__(self):
+        self._ids = {}
+        self._duplicates = {}
+        self._pending = []
+
+    @classmethod
+    def current(cls):
+        """
+        Returns the context of the pass in progress in this thread, or None.
+        """
+        return getattr(cls._local, 'ctx', None)
+
+    @classmethod
+    @contextmanager
+    def scope(cls):
+        """
+        Joins the pass in progress in this thread or, if there is none,
+        starts a new one, which is finished (references resolved) on exit.
+        """
+        ctx = cls.current()
+        if ctx is not None:
+            yield ctx
+            return
+
+        ctx = cls._local.ctx = cls()
+        try:
+            yield ctx
+            ctx.resolve()
+        finally:
+            cls._local.ctx = None
+
+    def register(self, obj, xml_el, id_attrs):
+        """
+        Indexes **obj** by the values of any of the **id_attrs** attributes
+        **xml_el** has.
+        """
+        for id_attr in id_attrs:
+            value = xml_el.get(id_attr)
+            if value is None:
+                continue
+
+            key = (id_attr, value)
+            if key in self._ids:
+                self._duplicates.setdefault(key, [self._ids[key]]).append(obj)
+            else:
+                self._ids[key] = obj
+
+    def lookup(self, id_attr, value, cls):
+        """
+        Returns the object of class **cls** whose **id_attr** is **value**,
+        or None if none has been loaded (yet).
+        """
+        key = (id_attr, value)
+        if key in self._duplicates:
+            found = [obj for obj in self._duplicates[key]
+                     if isinstance(obj, cls)]
+            if len(found) > 1:
+                raise AcornException((
+                    "{} objects of class \"{}\" have {} \"{}\"").format(
+                        len(found), cls.__name__, id_attr, value))
+            return found[0] if found else None
+
+        obj = self._ids.get(key)
+        if obj is not None and isinstance(obj, cls):
+            return obj
+        return None
+
+    def defer(self, id_attr, value, cls, assign):
+        """
+        Calls **assign** with the object :func:`lookup` finds once the whole
+        document has been loaded.
+        """
+        self._pending.append((id_attr, value, cls, assign))
+
+    def resolve(self):
+        pending, self._pending = self._pending, []
+        for id_attr, value, cls, assign in pending:
+            obj = self.lookup(id_attr, value, cls)
+            if obj is None:
+                raise AcornException((
+                    "No object of class \"{}\" with {} \"{}\" "
+                    "in the document").format(cls.__name__, id_attr, value))
+            assign(obj)
+
+
 class BaseAcornSource(object):
     """
     The base class for every source.
     """
 
+    always_loads = False
+    '''
+    Set to True by a source class whose :func:`fromxml` and
+    :func:`iterfromxml` always set the attribute (or raise).  Sub-classes
+    which override either don't inherit it, see :func:`loads_always`.
+    '''
+
     def __init__(self, meta):
         self.meta = meta
 
+    def loads_always(self):
+        """
+        True if loading is sure to set the attribute, that is if the class
+        which set :attr:`always_loads` also defines the :func:`fromxml` and
+        :func:`iterfromxml` in use.  Acorn then doesn't bother creating the
+        default for objects it is about to load.
+        """
+        cls = type(self)
+        for klass in cls.__mro__:
+            if 'always_loads' in klass.__dict__:
+                return klass.always_loads and \
+                    cls.fromxml is klass.fromxml and \
+                    cls.iterfromxml is klass.iterfromxml
+        return False
+
+    def _iterator(self, name):
+        """
+        Returns the bound method **name** ('iterfromxml', 'itertoxml' or
+        'iterupdate') which Acorn should use.  A source class which only
+        overrides :func:`fromxml` or :func:`toxml` doesn't get the iterator
+        of the class it extends, which wouldn't call the override, but
+        :class:`BaseAcornSource`'s, which does.  As with
+        :func:`loads_always`, an iterator is used only if the class defining
+        it also defines the :func:`fromxml` or :func:`toxml` in use.
+        """
+        cls = type(self)
+        plain = 'toxml' if name == 'itertoxml' else 'fromxml'
+        for klass in cls.__mro__:
+            if name in klass.__dict__:
+                if getattr(cls, plain) is getattr(klass, plain):
+                    return getattr(self, name)
+                break
+        return getattr(BaseAcornSource, name).__get__(self, cls)
+
     def create_default(self, name, obj):
         if self.meta.get('default') is not None:
             setattr(obj, name, self.meta['default'])
@@ -35,6 +250,70 @@ class BaseAcornSource(object):
     def toxml(self, name, obj, xml_el):
         raise AcornException("Must implement in inheriting class")
 
+    def iterfromxml(self, name, obj, xml_el):
+        """
+        Used by :func:`~acorn.Acorn.fromxml` instead of calling
+        :func:`fromxml` directly.  Returns an iterable of
+        ``(child_cls, child_el, attach, child)`` tuples, one for every
+        sub-object that still needs to be loaded.  Acorn loads each one from
+        *child_el* and passes the finished object to *attach* before pulling
+        the next tuple, which lets it walk arbitrarily deep documents with a
+        work stack instead of recursion.
+
+        *child* is normally None.  It may instead be an object returned by
+        :func:`~acorn.Acorn._fromxml_batch`, in which case only the
+        attributes which weren't loaded in the batch are loaded into it.
+
+        By default this just calls :func:`fromxml` and returns no
+        sub-objects, so sources which only override :func:`fromxml` keep
+        working.
+        """
+        self.fromxml(name, obj, xml_el)
+        return ()
+
+    def itertoxml(self, name, obj, xml_el):
+        """
+        Used by :func:`~acorn.Acorn.toxml` instead of calling :func:`toxml`
+        directly.  Returns an iterable of the sub-objects which still need to
+        be saved as children of *xml_el*.
+
+        By default this just calls :func:`toxml` and returns no sub-objects.
+        """
+        self.toxml(name, obj, xml_el)
+        return ()
+
+    def iterupdate(self, name, obj, xml_el, log):
+        """
+        Used by :func:`~acorn.Acorn.update_fromxml`.  Brings the attribute of
+        the existing object **obj** up to date with **xml_el**, changing it
+        only if needed and reporting changes to the
+        :class:`AcornChangeLog` **log**.  Returns an iterable of
+        ``(child, child_el)`` pairs for sub-objects which should in turn be
+        updated in place.
+
+        By default this loads the attribute into a blank object of the same
+        class and sets it on **obj** if the value differs.
+        """
+        scratch = type(obj).__new__(type(obj))
+        self.fromxml(name, scratch, xml_el)
+
+        new = getattr(scratch, name, _MISSING)
+        if new is _MISSING:
+            return ()
+
+        old = getattr(obj, name, _MISSING)
+        if old is _MISSING or not (old is new or old == new):
+            setattr(obj, name, new)
+            log.record(obj, name, 'set', new)
+
+        return ()
+
+    fromxml_batch = None
+    '''
+    Sources which can load the same attribute for many sibling objects at
+    once define this as a method ``fromxml_batch(name, objs, xml_els)``.
+    '''
+
 
 class AcornTextSource(BaseAcornSource):
     """
@@ -43,6 +322,8 @@ class AcornTextSource(BaseAcornSource):
 
     type = 'text'
 
+    always_loads = True
+
     @staticmethod
     def _get_text(name, xml_el):
         return xml_el.text
@@ -77,6 +358,113 @@ class AcornTextSource(BaseAcornSource):
 
         setattr(obj, name, val)
 
+    def fromxml_batch(self, name, objs, xml_els):
+        """
+        Loads the attribute for every object in **objs** from the matching
+        element in **xml_els**.
+
+        The raw values are gathered first and converted together, with
+        NumPy for int and float types when it is installed (it is imported on
+        first use).  The results are
+        the same as calling :func:`fromxml` for each object; if any value is
+        missing without a default, fails to convert or isn't one of the
+        options, this falls back to doing exactly that so the same exception
+        is raised.
+
+        Sub-classes which change how values are read or converted are loaded
+        with their :func:`fromxml`, one object at a time.
+        """
+        meta = self.meta
+
+        if not self._batchable():
+            for obj, xml_el in zip(objs, xml_els):
+                self.fromxml(name, obj, xml_el)
+            return
+
+        raw_vals = self._get_texts(name, xml_els)
+        vals = None
+        if _MISSING not in raw_vals or 'default' in meta:
+            present = [raw_val for raw_val in raw_vals
+                       if raw_val is not _MISSING]
+            try:
+                converted = self._convert_batch(present)
+            except (TypeError, ValueError, OverflowError):
+                converted = None
+
+            if converted is not None:
+                vals = self._fill_defaults(raw_vals, converted)
+
+        if vals is None:
+            for obj, xml_el in zip(objs, xml_els):
+                self.fromxml(name, obj, xml_el)
+            return
+
+        for obj, val in zip(objs, vals):
+            setattr(obj, name, val)
+
+    def _batchable(self):
+        """
+        Whether the values are read and converted by the stock methods,
+        which :func:`fromxml_batch` reproduces.
+        """
+        cls = type(self)
+        return cls.fromxml is AcornTextSource.fromxml and \
+            cls._process_val_fxml is AcornTextSource._process_val_fxml and \
+            (cls._get_texts is AcornTextSource._get_texts or
+             cls._get_text is AcornAttrSource._get_text)
+
+    def _get_texts(self, name, xml_els):
+        get_text = self._get_text
+        raw_vals = []
+        for xml_el in xml_els:
+            try:
+                raw_vals.append(get_text(name, xml_el))
+            except KeyError:
+                raw_vals.append(_MISSING)
+        return raw_vals
+
+    def _convert_batch(self, raw_vals):
+        """
+        Converts a list of raw values, returning None if any of them isn't
+        one of the options.
+        """
+        meta = self.meta
+        conv = meta['type']
+
+        # NumPy only gets strings, it converts None and others differently.
+        numpy = None
+        if conv is int or conv is float:
+            if all(type(raw_val) is str for raw_val in raw_vals):
+                numpy = _import_numpy()
+
+        if numpy is not None:
+            vals = numpy.array(raw_vals).astype(
+                numpy.int64 if conv is int else numpy.float64).tolist()
+        else:
+            vals = list(map(conv, raw_vals))
+
+        options = meta.get('options')
+        if options is not None:
+            try:
+                if not frozenset(options).issuperset(vals):
+                    return None
+            except TypeError:
+                # Unhashable options or values, check them one by one.
+                for val in vals:
+                    if val not in options:
+                        return None
+
+        return vals
+
+    def _fill_defaults(self, raw_vals, converted):
+        if len(converted) == len(raw_vals):
+            return converted
+
+        default = self.meta['default']
+        converted = iter(converted)
+        return [default if raw_val is _MISSING else next(converted)
+                for raw_val in raw_vals]
+
     def toxml(self, name, obj, xml_el):
         xml_el.text = self._process_val_txml(getattr(obj, name))
 
@@ -116,6 +504,9 @@ class AcornAttrSource(AcornTextSource):
     def _get_text(name, xml_el):
         return xml_el.attrib[name]
 
+    def _get_texts(self, name, xml_els):
+        return [xml_el.get(name, _MISSING) for xml_el in xml_els]
+
     def toxml(self, name, obj, xml_el):
         xml_el.attrib[name] = self._process_val_txml(getattr(obj, name))
 
@@ -137,7 +528,8 @@ class AcornSubTextSource(AcornTextSource):
         return child.text
 
     def toxml(self, name, obj, xml_el):
-        child = etree.SubElement(xml_el, self.meta.get('tag', name))
+        child = get_backend().SubElement(
+            xml_el, self.meta.get('tag', name))
         child.text = self._process_val_txml(getattr(obj, name))
 
 
@@ -151,21 +543,62 @@ class AcornChildSource(BaseAcornSource):
             setattr(obj, name, self.meta['type']())
 
     def fromxml(self, name, obj, xml_el):
+        for child_cls, child_el, attach, _ in self.iterfromxml(
+                name, obj, xml_el):
+            attach(child_cls.fromxml(child_el))
+
+    def iterfromxml(self, name, obj, xml_el):
         child_cls = self.meta['type']
         child_tag = child_cls.xml_tag
 
         child_el = xml_el.find(child_tag)
 
         if child_el is not None:
-            setattr(obj, name, child_cls.fromxml(child_el))
+            yield child_cls, child_el, partial(setattr, obj, name), None
 
         elif not self.meta.get('optional'):
             # We don't have the child and it's not optional, complain.
             raise AcornException((
                 "Object of tag \"{}\" should specify child of tag "
-                "\"{}\"".format(self.xml_tag, child_cls.xml_tag)))
+                "\"{}\"".format(obj.xml_tag, child_cls.xml_tag)))
+
+    def iterupdate(self, name, obj, xml_el, log):
+        """
+        Updates the existing child in place if it is of the right class,
+        otherwise loads a new one.  If an optional child has disappeared,
+        the attribute is reset the way a fresh load would leave it.
+        """
+        child_cls = self.meta['type']
+        child_el = xml_el.find(child_cls.xml_tag)
+        old = getattr(obj, name, None)
+
+        if child_el is None:
+            if not self.meta.get('optional'):
+                raise AcornException((
+                    "Object of tag \"{}\" should specify child of tag "
+                    "\"{}\"".format(obj.xml_tag, child_cls.xml_tag)))
+
+            if self.meta.get('default') is not None:
+                new = child_cls()
+                setattr(obj, name, new)
+                log.record(obj, name, 'set', new)
+            elif hasattr(obj, name):
+                delattr(obj, name)
+                log.record(obj, name, 'deleted')
+
+        elif type(old) is child_cls:
+            yield old, child_el
+
+        else:
+            new = child_cls.fromxml(child_el)
+            setattr(obj, name, new)
+            log.record(obj, name, 'set', new)
 
     def toxml(self, name, obj, xml_el):
+        for child in self.itertoxml(name, obj, xml_el):
+            child.toxml(xml_el)
+
+    def itertoxml(self, name, obj, xml_el):
         try:
             child = getattr(obj, name)
         except AttributeError:
@@ -175,8 +608,9 @@ class AcornChildSource(BaseAcornSource):
                     "Object \"{}\" of type \"{}\" "
                     "has no attribute "
                     "\"{}\"".format(obj, type(obj), name)))
+            return ()
         else:
-            child.toxml(xml_el)
+            return (child, )
 
 
 class AcornChildrenSource(BaseAcornSource):
@@ -210,22 +644,652 @@ class AcornChildrenSource(BaseAcornSource):
          <Weapon object at 0x7fab52......>,
          <Weapon object at 0x7fab52......>]
 
-    TODO: write about recursion trick for children/child
+    A class may list itself as the type of its own 'child' or 'children'
+    attributes to describe tree-shaped data.  Sub-objects are loaded and saved
+    with a work stack rather than by recursion, so such trees may be
+    arbitrarily deep.
+
+    Attributes with simple sources ('attr', 'text' and 'child.text') are
+    loaded for all the children together before the children's other
+    attributes, see :func:`~acorn.Acorn._fromxml_batch`.
+
+    If the children have an attribute which identifies them, name it with
+    'key'.  :func:`~acorn.Acorn.update_fromxml` then matches existing
+    children to the new document by it, rather than by position:
+
+    .. code-block:: python
+
+        'weapons': {'type': Weapon, 'src': 'children', 'key': 'name'}
     """
 
+    always_loads = True
+
+    def new_list(self, items=(), owner=None):
+        """
+        Returns a new list of **items** to hold the children.  If **owner**,
+        an object tracking changes, is given it is an
+        :class:`AcornTrackedList` owned by it.
+        """
+        if owner is None:
+            return list(items)
+        return AcornTrackedList(items, owner)
+
     def create_default(self, name, obj):
-        setattr(obj, name, [])
+        setattr(obj, name, self.new_list())
 
     def fromxml(self, name, obj, xml_el):
+        for child_cls, child_el, attach, _ in self.iterfromxml(
+                name, obj, xml_el):
+            attach(child_cls.fromxml(child_el))
+
+    def iterfromxml(self, name, obj, xml_el):
         child_cls = self.meta['type']
         child_tag = child_cls.xml_tag
 
-        children_objs = []
-        setattr(obj, name, children_objs)
+        setattr(obj, name, self.new_list())
+        # Fetch the list back, the object may have replaced it.
+        attach = getattr(obj, name).append
+
+        child_els = list(xml_el.iterfind(child_tag))
+        batch = child_cls._fromxml_batch(child_els, type(obj))
+
+        if batch is None:
+            for child in child_els:
+                yield child_cls, child, attach, None
+        else:
+            for child, child_obj in zip(child_els, batch):
+                yield child_cls, child, attach, child_obj
+
+    def _child_elements(self, xml_el):
+        """
+        Returns ``(child_cls, child_el)`` for each child element to load.
+        """
+        child_cls = self.meta['type']
+        return [(child_cls, child_el)
+                for child_el in xml_el.iterfind(child_cls.xml_tag)]
+
+    def iterupdate(self, name, obj, xml_el, log):
+        """
+        Matches the existing children to the child elements, by 'key' if
+        given, otherwise by position.  Matched children of the right class
+        are kept and updated in place, the others are loaded anew.  The list
+        itself is changed in place, and if it has a ``reindex`` method (see
+        :class:`AcornKeyedList`) that is called once the kept children have
+        been updated, since their keys may have changed.
+        """
+        key = self.meta.get('key')
+        if isinstance(key, (tuple, list)):
+            key = key[0]
+
+        old_list = getattr(obj, name, None)
+        if old_list is None:
+            setattr(obj, name, self.new_list())
+            old_list = getattr(obj, name)
+
+        if key is not None:
+            index = {}
+            for child in old_list:
+                index.setdefault(getattr(child, key, None), child)
+
+        new_list = []
+        used = set()
+        to_update = []
+        for i, (child_cls, child_el) in enumerate(
+                self._child_elements(xml_el)):
+            if key is not None:
+                scratch = child_cls.__new__(child_cls)
+                child_cls.acorn_content[key].fromxml(key, scratch, child_el)
+                match = index.get(getattr(scratch, key))
+            else:
+                match = old_list[i] if i < len(old_list) else None
+
+            if type(match) is child_cls and id(match) not in used:
+                used.add(id(match))
+                new_list.append(match)
+                to_update.append((match, child_el))
+            else:
+                new = child_cls.fromxml(child_el)
+                new_list.append(new)
+                log.record(obj, name, 'added', new)
+
+        for child in old_list:
+            if id(child) not in used:
+                log.record(obj, name, 'removed', child)
 
-        for child in xml_el.iterfind(child_tag):
-            children_objs.append(child_cls.fromxml(child))
+        kept_old = [child for child in old_list if id(child) in used]
+        kept_new = [child for child in new_list if id(child) in used]
+        if any(a is not b for a, b in zip(kept_old, kept_new)):
+            log.record(obj, name, 'reordered')
+
+        if len(new_list) != len(old_list) or \
+                any(a is not b for a, b in zip(old_list, new_list)):
+            old_list[:] = new_list
+
+        reindex = getattr(old_list, 'reindex', None)
+        if reindex is not None and to_update:
+            return self._then(to_update, reindex)
+        return to_update
+
+    @staticmethod
+    def _then(tasks, after):
+        """
+        Yields **tasks**, then calls **after**.  Acorn only asks for the next
+        task once the sub-object of the previous one has been dealt with.
+        """
+        for task in tasks:
+            yield task
+        after()
 
     def toxml(self, name, obj, xml_el):
-        for child in getattr(obj, name):
+        for child in self.itertoxml(name, obj, xml_el):
             child.toxml(xml_el)
+
+    def itertoxml(self, name, obj, xml_el):
+        return getattr(obj, name)
+
+
+class AcornRefSource(BaseAcornSource):
+    """
+    Source to refer to an object loaded elsewhere in the same document,
+    through an attribute holding its id.
+
+    .. code-block:: XML
+        <world>
+            <weapon id='w17' type='sword'/>
+            <person name='Roger' weapon_ref='w17'/>
+        </world>
+
+    .. code-block:: python
+
+        class Weapon(Acorn):
+            xml_tag = 'weapon'
+            acorn_content = Acorn.parse_content({
+                'id':   {'type': str},
+                'type': {'type': str},
+            })
+
+        class Person(Acorn):
+            xml_tag = 'person'
+            acorn_content = Acorn.parse_content({
+                'name':   {'type': str},
+                'weapon': {'type': Weapon, 'src': 'ref',
+                           'attr': 'weapon_ref'},
+            })
+
+        world = World.fromxml(...)
+        world.people[0].weapon is world.weapons[0]
+
+        True
+
+    While loading, every object whose element has an id is indexed, so
+    references are resolved with a dict lookup.  References to objects
+    which come later in the document are resolved once the whole document
+    has been loaded (after the referring object's 'fromxml' hooks have
+    run).  When saving, only the target's id is written.
+
+    'attr' is the XML attribute holding the id, by default the attribute
+    name.  'id' is the attribute of the target which holds its id, both in
+    XML and in Python, by default 'id'.  If the reference isn't in the XML
+    it is an error, unless 'optional' is set.
+    """
+
+    id_attrs = ()
+    '''
+    Names of all id attributes used by 'ref' sources.  Elements are indexed
+    by these while loading.
+    '''
+
+    _lock = threading.Lock()
+
+    def __init__(self, meta):
+        super(AcornRefSource, self).__init__(meta)
+
+        id_attr = meta.get('id', 'id')
+        with self._lock:
+            if id_attr not in AcornRefSource.id_attrs:
+                AcornRefSource.id_attrs = \
+                    AcornRefSource.id_attrs + (id_attr, )
+
+    def _load(self, name, obj, xml_el, assign):
+        """
+        Calls **assign** with the target, now or at the end of the load.
+        Returns False if the reference isn't in the XML.
+        """
+        meta = self.meta
+        value = xml_el.get(meta.get('attr', name))
+        if value is None:
+            if not meta.get('optional'):
+                raise AcornException((
+                    "No reference \"{}\" in XML element").format(name))
+            return False
+
+        ctx = AcornLoadContext.current()
+        if ctx is None:
+            raise AcornException(
+                "'ref' attributes can only be loaded by Acorn.fromxml")
+
+        id_attr = meta.get('id', 'id')
+        target = ctx.lookup(id_attr, value, meta['type'])
+        if target is None:
+            ctx.defer(id_attr, value, meta['type'], assign)
+        else:
+            assign(target)
+        return True
+
+    def fromxml(self, name, obj, xml_el):
+        self._load(name, obj, xml_el, partial(setattr, obj, name))
+
+    def iterupdate(self, name, obj, xml_el, log):
+        def assign(target):
+            if getattr(obj, name, None) is not target:
+                setattr(obj, name, target)
+                log.record(obj, name, 'set', target)
+
+        if not self._load(name, obj, xml_el, assign) and hasattr(obj, name):
+            delattr(obj, name)
+            log.record(obj, name, 'deleted')
+
+        return ()
+
+    def toxml(self, name, obj, xml_el):
+        meta = self.meta
+        target = getattr(obj, name, None)
+        if target is None:
+            if not meta.get('optional'):
+                raise AcornException((
+                    "Object \"{}\" of type \"{}\" "
+                    "has no reference "
+                    "\"{}\"".format(obj, type(obj), name)))
+            return
+
+        id_attr = meta.get('id', 'id')
+        value = getattr(target, id_attr)
+        id_src = target.acorn_content.get(id_attr)
+        if isinstance(id_src, AcornTextSource):
+            value = id_src._process_val_txml(value)
+        else:
+            value = str(value)
+
+        xml_el.set(meta.get('attr', name), value)
+
+
+class AcornTrackedList(list):
+    """
+    The list held by 'children' attributes of classes which set
+    :attr:`~acorn.Acorn.acorn_track_changes`.  Any change to the list marks
+    its owner, and so the owner's ancestors, as changed.
+    """
+
+    # copy and pickle fill the list before restoring its __dict__.
+    _acorn_owner = None
+
+    def __init__(self, items=(), owner=None):
+        super(AcornTrackedList, self).__init__(items)
+        self._acorn_owner = owner
+        if owner is not None:
+            for item in self:
+                owner._acorn_adopt(item)
+
+    def _changed(self, items=()):
+        owner = self._acorn_owner
+        if owner is not None:
+            for item in items:
+                owner._acorn_adopt(item)
+            owner.acorn_mark_dirty()
+
+    def append(self, item):
+        super(AcornTrackedList, self).append(item)
+        self._changed((item, ))
+
+    def extend(self, items):
+        items = list(items)
+        super(AcornTrackedList, self).extend(items)
+        self._changed(items)
+
+    def insert(self, index, item):
+        super(AcornTrackedList, self).insert(index, item)
+        self._changed((item, ))
+
+    def remove(self, item):
+        super(AcornTrackedList, self).remove(item)
+        self._changed()
+
+    def pop(self, *ar):
+        item = super(AcornTrackedList, self).pop(*ar)
+        self._changed()
+        return item
+
+    def clear(self):
+        super(AcornTrackedList, self).clear()
+        self._changed()
+
+    def sort(self, *ar, **kw):
+        super(AcornTrackedList, self).sort(*ar, **kw)
+        self._changed()
+
+    def reverse(self):
+        super(AcornTrackedList, self).reverse()
+        self._changed()
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            value = list(value)
+            super(AcornTrackedList, self).__setitem__(index, value)
+            self._changed(value)
+        else:
+            super(AcornTrackedList, self).__setitem__(index, value)
+            self._changed((value, ))
+
+    def __delitem__(self, index):
+        super(AcornTrackedList, self).__delitem__(index)
+        self._changed()
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+    def __imul__(self, n):
+        super(AcornTrackedList, self).__imul__(n)
+        self._changed()
+        return self
+
+
+class AcornKeyedList(AcornTrackedList):
+    """
+    The list held by 'keyed_children' attributes (see
+    :class:`AcornKeyedChildrenSource`).  It is an ordinary list, in document
+    order, which also indexes its items by one or more key attributes:
+
+    .. code-block:: python
+
+        person.weapons.get('dirk')
+        person.weapons.get(17, by='id')
+
+    Adding an item whose key is already taken raises
+    :class:`AcornException` and leaves the list as it was.  Items whose key
+    is None aren't indexed.
+
+    Keys are read when items are added.  If the key attribute of an item
+    already in the list is changed, call :func:`reindex`.
+
+    If **owner** is given it tracks changes, as for
+    :class:`AcornTrackedList`.
+    """
+
+    _acorn_keys = ()
+    _acorn_index = None
+
+    def __init__(self, items=(), keys=('name', ), owner=None):
+        super(AcornKeyedList, self).__init__(items, owner)
+        self._acorn_keys = tuple(keys)
+        self._acorn_index = self._build_index(self)
+
+    def get(self, value, default=None, by=None):
+        """
+        Returns the item whose key attribute **by** (by default the first
+        key) is **value**, or **default**.
+        """
+        return self._acorn_index[by or self._acorn_keys[0]].get(
+            value, default)
+
+    def mapping(self, by=None):
+        """
+        Returns a read-only mapping of the values of key attribute **by** (by
+        default the first key) to the items.
+        """
+        return MappingProxyType(self._acorn_index[by or self._acorn_keys[0]])
+
+    def reindex(self):
+        """
+        Rebuilds the index from the items' current keys.
+        """
+        self._acorn_index = self._build_index(self)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_acorn_index', None)
+        return state
+
+    def __setstate__(self, state):
+        # pickle restores the items before the state, copy after it.
+        self.__dict__.update(state)
+        self._acorn_index = self._build_index(self)
+
+    def _build_index(self, items):
+        index = dict((key, {}) for key in self._acorn_keys)
+        self._add_keys(index, items)
+        return index
+
+    def _add_keys(self, index, items):
+        """
+        Adds **items** to **index**, raising before changing anything if a
+        key is taken.
+        """
+        if index is None:
+            return
+
+        added = []
+        for key in self._acorn_keys:
+            taken = index[key]
+            new = {}
+            for item in items:
+                value = getattr(item, key, None)
+                if value is None:
+                    continue
+                if value in taken or value in new:
+                    raise AcornException(
+                        "Duplicate key {}={!r}".format(key, value))
+                new[value] = item
+            added.append((taken, new))
+
+        for taken, new in added:
+            taken.update(new)
+
+    def _remove_keys(self, items):
+        index = self._acorn_index
+        if index is None:
+            return
+
+        for key in self._acorn_keys:
+            taken = index[key]
+            for item in items:
+                value = getattr(item, key, None)
+                if value is not None and taken.get(value) is item:
+                    del taken[value]
+
+    def append(self, item):
+        # The loaders' path, kept short for the common case of one key.
+        index = self._acorn_index
+        if index is not None and len(self._acorn_keys) == 1:
+            key = self._acorn_keys[0]
+            value = getattr(item, key, None)
+            if value is not None:
+                taken = index[key]
+                if value in taken:
+                    raise AcornException(
+                        "Duplicate key {}={!r}".format(key, value))
+                taken[value] = item
+        else:
+            self._add_keys(index, (item, ))
+
+        if self._acorn_owner is None:
+            list.append(self, item)
+        else:
+            super(AcornKeyedList, self).append(item)
+
+    def extend(self, items):
+        items = list(items)
+        self._add_keys(self._acorn_index, items)
+        super(AcornKeyedList, self).extend(items)
+
+    def insert(self, index, item):
+        self._add_keys(self._acorn_index, (item, ))
+        super(AcornKeyedList, self).insert(index, item)
+
+    def remove(self, item):
+        # list.remove compares with ==, find the item actually removed.
+        del self[self.index(item)]
+
+    def pop(self, *ar):
+        item = super(AcornKeyedList, self).pop(*ar)
+        self._remove_keys((item, ))
+        return item
+
+    def clear(self):
+        super(AcornKeyedList, self).clear()
+        self._acorn_index = self._build_index(())
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            value = list(value)
+            old, new = self[index], value
+        else:
+            old, new = (self[index], ), (value, )
+
+        # Swap the keys of the replaced items for those of the new ones,
+        # putting them back if a key is taken or the list refuses.
+        self._remove_keys(old)
+        added = False
+        try:
+            self._add_keys(self._acorn_index, new)
+            added = True
+            super(AcornKeyedList, self).__setitem__(index, value)
+        except Exception:
+            if added:
+                self._remove_keys(new)
+            self._add_keys(self._acorn_index, old)
+            raise
+
+    def __delitem__(self, index):
+        removed = self[index] if isinstance(index, slice) else (self[index], )
+        super(AcornKeyedList, self).__delitem__(index)
+        self._remove_keys(removed)
+
+    def __imul__(self, n):
+        new_index = self._build_index(list(self) * n)
+        super(AcornKeyedList, self).__imul__(n)
+        self._acorn_index = new_index
+        return self
+
+
+class AcornKeyedChildrenSource(AcornChildrenSource):
+    """
+    Like :class:`AcornChildrenSource`, but the children are loaded into an
+    :class:`AcornKeyedList`, indexed by the attribute named by 'key', or each
+    of several attributes:
+
+    .. code-block:: python
+
+        class Person(Acorn):
+            xml_tag = 'person'
+            acorn_content = Acorn.parse_content({
+                ...
+                'weapons': {'type': Weapon, 'src': 'keyed_children',
+                            'key': ('name', 'id')}
+            })
+
+        person = Person.fromxml(...)
+        print(person.weapons.get('dirk'))
+
+        <Weapon object at 0x7fab52......>
+
+    Loading fails with :class:`AcornException` if two children have the
+    same key.  :func:`~acorn.Acorn.update_fromxml` matches children by the
+    first key.
+
+    Lists given to the constructor are turned into an
+    :class:`AcornKeyedList`; to replace the list later, assign one made with
+    :func:`new_list`.
+    """
+
+    def new_list(self, items=(), owner=None):
+        keys = self.meta.get('key')
+        if keys is None:
+            raise AcornException(
+                "'keyed_children' sources need a 'key'")
+        if isinstance(keys, str):
+            keys = (keys, )
+        return AcornKeyedList(items, keys, owner)
+
+
+class AcornPolyChildrenSource(AcornChildrenSource):
+    """
+    Like :class:`AcornChildrenSource`, but the children may be of several
+    different classes.  Every direct child is looked at exactly once, in
+    document order, and loaded with the class registered for it.  Children
+    which match no class are ignored.
+
+    .. code-block:: XML
+        <person>
+            <sword length='3'/>
+            <bow/>
+            <sword length='4'/>
+        </person>
+
+    .. code-block:: python
+
+        class Person(Acorn):
+            xml_tag = 'person'
+            acorn_content = Acorn.parse_content({
+                ...
+                'weapons': {'types': [Sword, Bow], 'src': 'poly_children'}
+            })
+
+        person = Person.fromxml(...)
+        print(person.weapons)
+
+        [<Sword object at 0x7fab52......>,
+         <Bow object at 0x7fab52......>,
+         <Sword object at 0x7fab52......>]
+
+    'types' is either a list of classes, which are matched by their
+    :attr:`~acorn.Acorn.xml_tag`, or a dict mapping tags to classes.  If a
+    'discriminator' attribute name is given, the dict may also map
+    ``(tag, attribute value)`` pairs to classes; those take precedence over
+    a plain tag:
+
+    .. code-block:: python
+
+        'weapons': {
+            'src': 'poly_children',
+            'discriminator': 'kind',
+            'types': {
+                ('weapon', 'sword'): Sword,
+                ('weapon', 'bow'):   Bow,
+                'weapon':            Weapon,
+            }
+        }
+    """
+
+    always_loads = True
+
+    def _get_dispatch(self):
+        types = self.meta['types']
+        if isinstance(types, dict):
+            return types
+        return dict((child_cls.xml_tag, child_cls) for child_cls in types)
+
+    def _child_elements(self, xml_el):
+        dispatch = self._get_dispatch()
+        discriminator = self.meta.get('discriminator')
+
+        child_els = []
+        for child in xml_el:
+            child_cls = None
+            if discriminator is not None:
+                child_cls = dispatch.get((child.tag, child.get(discriminator)))
+            if child_cls is None:
+                child_cls = dispatch.get(child.tag)
+
+            if child_cls is not None:
+                child_els.append((child_cls, child))
+
+        return child_els
+
+    def iterfromxml(self, name, obj, xml_el):
+        setattr(obj, name, [])
+        # Fetch the list back, the object may have replaced it.
+        attach = getattr(obj, name).append
+
+        for child_cls, child in self._child_elements(xml_el):
+            yield child_cls, child, attach, None
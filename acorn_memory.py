@@ -0,0 +1,303 @@
+"""
+Measuring the memory used by Acorn objects.
+
+:func:`acorn_memory_report` sizes a loaded object graph, and
+:class:`AcornMemoryTrace` attributes the memory allocated while loading or
+saving to the classes being processed.
+
+.. code-block:: python
+
+    from acorn_memory import acorn_memory_report, AcornMemoryTrace
+
+    with AcornMemoryTrace() as trace:
+        world = World.fromxml('world.xml')
+    print(trace)
+
+    print(acorn_memory_report(world))
+"""
+
+
+from sys import getsizeof
+import tracemalloc
+
+import acorn
+from acorn import Acorn, _acorn_compiled
+
+
+class AcornMemoryReport(object):
+    """
+    The memory used by an object graph, as measured by
+    :func:`acorn_memory_report`.  Sizes are in bytes, as given by
+    :func:`sys.getsizeof`, and every object is counted once, however many
+    times it is referred to.
+    """
+
+    def __init__(self):
+        self.total = 0
+        '''
+        Size of the whole graph.
+        '''
+
+        self.objects = 0
+        '''
+        Number of Acorn objects in the graph.
+        '''
+
+        self.classes = {}
+        '''
+        ``{cls: [objects, size]}``.  The size of an object is that of the
+        object, its __dict__ and its attribute values, but not of the
+        objects beneath it.  These add up to :attr:`total`.
+        '''
+
+        self.attributes = {}
+        '''
+        ``{(cls, name): size}`` of the values of each attribute, including
+        attributes not in :attr:`~acorn.Acorn.acorn_content`.  For 'children'
+        attributes, this is the size of the list itself.
+        '''
+
+        self.children = {}
+        '''
+        ``{(cls, name): [lists, items, size]}`` for 'children' attributes,
+        where size includes the lists and everything beneath them.
+        '''
+
+    def __str__(self):
+        def name(cls):
+            return cls.__name__
+
+        lines = ['{} bytes in {} objects'.format(self.total, self.objects),
+                 '', '{:<40}{:>12}{:>14}'.format('class', 'objects', 'bytes')]
+        for cls, (count, size) in sorted(
+                self.classes.items(), key=lambda i: -i[1][1]):
+            lines.append('{:<40}{:>12}{:>14}'.format(name(cls), count, size))
+
+        lines += ['', '{:<52}{:>14}'.format('attribute', 'bytes')]
+        for (cls, aname), size in sorted(
+                self.attributes.items(), key=lambda i: -i[1]):
+            lines.append('{:<52}{:>14}'.format(
+                name(cls) + '.' + aname, size))
+
+        if self.children:
+            lines += ['', '{:<40}{:>12}{:>14}'.format(
+                'children', 'items', 'bytes')]
+            for (cls, aname), (lists, items, size) in sorted(
+                    self.children.items(), key=lambda i: -i[1][2]):
+                lines.append('{:<40}{:>12}{:>14}'.format(
+                    name(cls) + '.' + aname, items, size))
+
+        return '\n'.join(lines)
+
+
+def acorn_memory_report(obj):
+    """
+    Returns an :class:`AcornMemoryReport` of the memory used by **obj** and
+    the objects beneath it.  The graph is walked through each class's
+    :attr:`~acorn.Acorn.acorn_content`: 'child' and 'children' attributes
+    lead to the sub-objects, 'ref' attributes are left to the attributes
+    holding their targets.
+
+    Attribute values are sized deeply through lists, tuples, sets and
+    dicts; other values, such as the elements kept by classes which track
+    changes, only by themselves.
+    """
+    report = AcornMemoryReport()
+    seen = set([id(obj)])
+    # Objects in the order they are found, each with the sub-objects it was
+    # the first to lead to, by attribute.
+    order = []
+    found = {}
+    class_kinds = {}
+
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        cls = type(obj)
+        kinds = class_kinds.get(cls)
+        if kinds is None:
+            kinds = class_kinds[cls] = dict(
+                (aname, kind)
+                for aname, kind, meta in _acorn_compiled(cls)[4])
+
+        size = getsizeof(obj)
+        state = obj.__dict__
+        seen.add(id(state))
+        size += getsizeof(state)
+
+        subs = []
+        for aname, value in state.items():
+            kind = kinds.get(aname, 'value')
+
+            if kind == 'child':
+                new = _new_objects((value, ), seen)
+            elif kind == 'children':
+                new = _new_objects(value, seen)
+            else:
+                new = ()
+
+            if kind == 'ref':
+                continue
+            elif type(value) in _SCALARS:
+                if id(value) in seen:
+                    n = 0
+                else:
+                    seen.add(id(value))
+                    n = getsizeof(value)
+            else:
+                # Acorn objects are skipped, so for 'children' this is the
+                # list.
+                n = _deep_size(value, seen)
+
+            key = (cls, aname)
+            report.attributes[key] = report.attributes.get(key, 0) + n
+            size += n
+
+            if kind == 'children':
+                stats = report.children.setdefault(key, [0, 0, 0])
+                stats[0] += 1
+                stats[1] += len(value)
+            if new:
+                subs.append((key, kind, n, new))
+                stack.extend(reversed(new))
+
+        stats = report.classes.setdefault(cls, [0, 0])
+        stats[0] += 1
+        stats[1] += size
+        report.objects += 1
+        report.total += size
+
+        order.append(obj)
+        found[id(obj)] = (size, subs)
+
+    # Objects are always found after the objects leading to them, so going
+    # backwards the sizes beneath each object are known when it's reached.
+    beneath = {}
+    for obj in reversed(order):
+        size, subs = found.pop(id(obj))
+        for key, kind, n, new in subs:
+            below = sum(beneath[id(sub)] for sub in new)
+            size += below
+            if kind == 'children':
+                report.children[key][2] += below
+        beneath[id(obj)] = size
+
+    for key, stats in report.children.items():
+        stats[2] += report.attributes[key]
+
+    return report
+
+
+_SCALARS = frozenset((str, int, float, bool, bytes, type(None)))
+
+
+def _new_objects(values, seen):
+    """
+    Returns the Acorn objects among **values** not counted yet, and marks
+    them as counted.
+    """
+    new = []
+    for value in values:
+        if isinstance(value, Acorn) and id(value) not in seen:
+            seen.add(id(value))
+            new.append(value)
+    return new
+
+
+def _deep_size(value, seen):
+    """
+    Size of **value** and of what it contains, skipping Acorn objects and
+    anything already in **seen**.
+    """
+    total = 0
+    stack = [value]
+    while stack:
+        value = stack.pop()
+        if id(value) in seen or isinstance(value, Acorn):
+            continue
+        seen.add(id(value))
+        total += getsizeof(value)
+
+        if isinstance(value, dict):
+            stack.extend(value.keys())
+            stack.extend(value.values())
+        elif isinstance(value, (list, tuple, set, frozenset)):
+            stack.extend(value)
+        else:
+            continue
+
+        # Sub-classes, such as the lists of 'children' attributes, may keep
+        # more in their __dict__.
+        state = getattr(value, '__dict__', None)
+        if state is not None:
+            stack.append(state)
+
+    return total
+
+
+class AcornMemoryTrace(object):
+    """
+    Context manager which traces memory allocations (with
+    :mod:`tracemalloc`) during :func:`~acorn.Acorn.fromxml` and
+    :func:`~acorn.Acorn.toxml`, and attributes them to the class of the
+    object being loaded or saved at the time.
+
+    Afterwards :attr:`classes` holds ``{(event, cls): [allocated, peak]}``,
+    where *event* is 'fromxml' or 'toxml', *allocated* is the memory
+    allocated, net of what was freed, while working on objects of *cls*, and
+    *peak* is the highest that allocations went, above where they were,
+    during any one stretch of work on such an object.
+
+    Tracing slows things down considerably, and is meant to be used by one
+    thread at a time.  If :mod:`tracemalloc` is already tracing it is left
+    running, but its peak is reset as the trace goes.
+    """
+
+    def __init__(self):
+        self.classes = {}
+        self._current = None
+        self._base = 0
+        self._started = False
+
+    def __enter__(self):
+        self._started = not tracemalloc.is_tracing()
+        if self._started:
+            tracemalloc.start()
+
+        self._current = None
+        self._base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        acorn._acorn_trace = self._switch
+        return self
+
+    def __exit__(self, *exc_info):
+        acorn._acorn_trace = None
+        self._switch(None, None)
+        if self._started:
+            tracemalloc.stop()
+
+    def _switch(self, event, cls):
+        """
+        Called by the loaders and savers when they move on to an object of
+        class **cls**.
+        """
+        current, peak = tracemalloc.get_traced_memory()
+
+        if self._current is not None:
+            stats = self.classes.get(self._current)
+            if stats is None:
+                stats = self.classes[self._current] = [0, 0]
+            stats[0] += current - self._base
+            stats[1] = max(stats[1], peak - self._base)
+
+        self._current = (event, cls) if cls is not None else None
+        self._base = current
+        tracemalloc.reset_peak()
+
+    def __str__(self):
+        lines = ['{:<40}{:>14}{:>14}'.format('class', 'allocated', 'peak')]
+        for (event, cls), (allocated, peak) in sorted(
+                self.classes.items(), key=lambda i: -i[1][0]):
+            lines.append('{:<40}{:>14}{:>14}'.format(
+                '{} {}'.format(event, cls.__name__), allocated, peak))
+        return '\n'.join(lines)
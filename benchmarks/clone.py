@@ -0,0 +1,100 @@
+"""
+Compares the ways of copying a loaded object graph: :func:`Acorn.clone`,
+:func:`copy.deepcopy`, and saving to XML and loading again.
+
+    python benchmarks/clone.py [people]
+"""
+
+
+import copy
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from __init__ import get_backend
+from acorn import Acorn
+
+
+class Weapon(Acorn):
+    xml_tag = 'weapon'
+    acorn_content = Acorn.parse_content({
+        'id':     {'type': str},
+        'damage': {'type': int, 'default': 1},
+    })
+
+
+class Item(Acorn):
+    xml_tag = 'item'
+    acorn_content = Acorn.parse_content({
+        'name':   {'type': str},
+        'weight': {'type': float, 'default': 0.0},
+    })
+
+
+class Person(Acorn):
+    xml_tag = 'person'
+    acorn_content = Acorn.parse_content({
+        'name':   {'type': str},
+        'weapon': {'type': Weapon, 'src': 'ref', 'optional': True},
+        'items':  {'type': Item, 'src': 'children'},
+    })
+
+
+class World(Acorn):
+    xml_tag = 'world'
+    acorn_content = Acorn.parse_content({
+        'people':  {'type': Person, 'src': 'children'},
+        'weapons': {'type': Weapon, 'src': 'children'},
+    })
+
+
+def world(people):
+    """
+    A world of **people** people with five items each, sharing a tenth as
+    many weapons.
+    """
+    weapons = [Weapon(id='w{}'.format(i), damage=i)
+               for i in range(max(1, people // 10))]
+    return World(weapons=weapons, people=[
+        Person(name='p{}'.format(i), weapon=weapons[i % len(weapons)],
+               items=[Item(name='i{}'.format(j), weight=j / 2)
+                      for j in range(5)])
+        for i in range(people)])
+
+
+def best_of(fn, runs=3):
+    """
+    Returns the result of **fn** and the shortest time it took.
+    """
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return result, min(times)
+
+
+def main(people):
+    original = world(people)
+    objects = 1 + len(original.weapons) + 6 * people
+
+    def deepcopy():
+        return copy.deepcopy(original)
+
+    def roundtrip():
+        return World.fromxml(original.toxml())
+
+    print('{} objects ({}):'.format(objects, get_backend().name))
+    for name, fn in (('clone', original.clone),
+                     ('deepcopy', deepcopy),
+                     ('xml round trip', roundtrip)):
+        result, elapsed = best_of(fn)
+        assert result == original and result is not original, name
+        assert result.people[0].weapon is result.weapons[0], name
+        print('  {:<16}{:.3f}s'.format(name, elapsed))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,61 @@
+"""
+Loads and saves arbitrarily deep documents, which used to hit Python's
+recursion limit.
+
+    python benchmarks/deep.py [depth]
+"""
+
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from __init__ import get_backend
+from acorn import Acorn
+
+
+class Node(Acorn):
+    xml_tag = 'n'
+    acorn_content = Acorn.parse_content({
+        'v':   {'type': int},
+        'kid': {'type': None, 'src': 'child', 'optional': True},
+    })
+
+Node.acorn_content['kid'].meta['type'] = Node
+
+
+def chain(depth):
+    """
+    A document nesting **depth** elements.
+    """
+    backend = get_backend()
+    root = el = backend.Element('n', v='0')
+    for i in range(1, depth):
+        el = backend.SubElement(el, 'n', v=str(i))
+    return root
+
+
+def main(depth):
+    root = chain(depth)
+
+    start = time.perf_counter()
+    obj = Node.fromxml(root)
+    loaded = time.perf_counter()
+    el = obj.toxml()
+    saved = time.perf_counter()
+
+    # Walk back down to check nothing was lost.
+    n = 0
+    while el is not None:
+        n += 1
+        el = el.find('n')
+    assert n == depth, n
+
+    print('{} levels ({}): load {:.3f}s, save {:.3f}s'.format(
+        depth, get_backend().name, loaded - start, saved - loaded))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,114 @@
+"""
+Stress test for loading and saving in threads while other threads register
+and unregister sources, add and remove hooks and define new classes.  Exits
+with an error if anything was lost or mixed up on the way.
+
+    python benchmarks/threads.py [rounds]
+"""
+
+
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from __init__ import get_backend
+from acorn import Acorn
+from acorn_base import AcornAttrSource
+
+
+class Leaf(Acorn):
+    xml_tag = 'c'
+    acorn_content = Acorn.parse_content({
+        'v': {'type': int},
+    })
+
+
+class Parent(Acorn):
+    xml_tag = 'p'
+    acorn_content = Acorn.parse_content({
+        'cs': {'type': Leaf, 'src': 'children'},
+    })
+
+
+def documents(count, size):
+    """
+    **count** documents of **size** leaves each, the first leaf of document
+    *j* holding *j*.
+    """
+    backend = get_backend()
+    docs = []
+    for j in range(count):
+        root = backend.Element('p')
+        for i in range(j, j + size):
+            backend.SubElement(root, 'c', v=str(i))
+        docs.append(root)
+    return docs
+
+
+def churn(stop, errors):
+    """
+    Keeps changing the source registry, the hook tables and the set of
+    compiled classes until **stop** is set.
+    """
+    def hook(event, event_cls, obj):
+        pass
+
+    try:
+        i = 0
+        while not stop.is_set():
+            Acorn.register_src('tmp{}'.format(i % 5), AcornAttrSource)
+            Acorn.unregister_src('tmp{}'.format((i + 2) % 5))
+            Leaf.add_hook('fromxml', hook)
+            Leaf.remove_hook('fromxml', hook)
+
+            class Other(Acorn):
+                xml_tag = 'x'
+                acorn_content = Acorn.parse_content({
+                    'a': {'type': int, 'src': 'attr'},
+                })
+            Other.fromxml(get_backend().Element('x', a=str(i)))
+            i += 1
+    except Exception as e:
+        errors.append(e)
+
+
+def main(rounds, churners=4, workers=8):
+    docs = documents(200, 200)
+    stop = threading.Event()
+    errors = []
+    threads = [threading.Thread(target=churn, args=(stop, errors))
+               for _ in range(churners)]
+    for t in threads:
+        t.start()
+
+    start = time.perf_counter()
+    try:
+        for _ in range(rounds):
+            objs = Parent.fromxml_many(docs, workers=workers)
+            assert [obj.cs[0].v for obj in objs] == list(range(len(docs)))
+            assert all(len(obj.cs) == 200 for obj in objs)
+
+            els = Acorn.toxml_many(objs, workers=workers)
+            assert [el[0].get('v') for el in els] == \
+                [str(j) for j in range(len(docs))]
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
+    elapsed = time.perf_counter() - start
+
+    if errors:
+        raise errors[0]
+    leftovers = [name for name in Acorn.__sources__ if name.startswith('tmp')]
+    assert len(leftovers) <= 5, leftovers
+    assert not Leaf.__hooks__.get('fromxml'), Leaf.__hooks__
+
+    print('{} rounds ({}, {} churning threads): {:.3f}s'.format(
+        rounds, get_backend().name, churners, elapsed))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
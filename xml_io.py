@@ -0,0 +1,217 @@
+"""
+Reading and writing of XML files for :func:`~acorn.Acorn.fromxml` and
+:func:`~acorn.Acorn.toxml`.
+
+Compressed files are handled transparently.  When reading, the compression
+is detected from the first bytes of the file; when writing, it is chosen by
+the file's extension.  gzip (.gz), bzip2 (.bz2) and xz (.xz) are always
+available, zstd (.zst) is available if Python provides
+:mod:`compression.zstd` or the :mod:`zstandard` package is installed.
+Compressed data is streamed through the codec, so no temporary files are
+needed.
+"""
+
+
+import io
+import os
+import stat
+
+from __init__ import get_backend, NutException
+
+
+BUFFER_SIZE = 1 << 20
+'''
+Size of the buffer placed between the XML library and a compressed stream.
+'''
+
+_MAGIC = (
+    (b'\x1f\x8b', 'gz'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'\x28\xb5\x2f\xfd', 'zst'),
+)
+
+_EXTENSIONS = {
+    '.gz':  'gz',
+    '.bz2': 'bz2',
+    '.xz':  'xz',
+    '.zst': 'zst',
+}
+
+# {kind: codec module, or None if unavailable}, filled in by _codec.
+_CODECS = {}
+
+
+def _codec(kind):
+    """
+    Returns the module handling compression **kind**, or None if it isn't
+    available.  The codecs are imported on first use, so that importing
+    Nuts stays quick.
+    """
+    try:
+        return _CODECS[kind]
+    except KeyError:
+        pass
+
+    if kind == 'gz':
+        import gzip as codec
+    elif kind == 'bz2':
+        import bz2 as codec
+    elif kind == 'xz':
+        import lzma as codec
+    else:
+        try:
+            # Python 3.14+
+            from compression import zstd as codec
+        except ImportError:
+            try:
+                import zstandard as codec
+            except ImportError:
+                codec = None
+
+    _CODECS[kind] = codec
+    return codec
+
+
+def compression_of(path, mode='r'):
+    """
+    Returns the kind of compression of the file at **path** ('gz', 'bz2',
+    'xz' or 'zst'), or None if it is not compressed.
+
+    **mode**
+        'r' to detect the compression from the file's content (the file must
+        exist), 'w' to choose it from the file's extension.
+    """
+    if mode == 'r':
+        with open(path, 'rb') as f:
+            head = f.read(6)
+        for magic, kind in _MAGIC:
+            if head.startswith(magic):
+                return kind
+        return None
+    else:
+        return _EXTENSIONS.get(os.path.splitext(path)[1].lower())
+
+
+def open_xml(path, mode='r'):
+    """
+    Opens the file at **path** for binary reading (**mode** 'r') or writing
+    (**mode** 'w'), decompressing or compressing as needed.  The returned
+    file is buffered with :data:`BUFFER_SIZE`.
+    """
+    return _open(path, mode, compression_of(path, mode))
+
+
+def _open(path, mode, kind, fileobj=None):
+    """
+    Opens **path**, compressed as **kind**.  If **fileobj**, an open binary
+    file, is given the compressed data goes there instead, and **path** is
+    only the name gzip records in its header.
+    """
+    if kind is None:
+        return open(path, mode + 'b', buffering=BUFFER_SIZE)
+
+    codec = _codec(kind)
+    if codec is None:
+        raise NutException((
+            "Can't open \"{}\", zstd support requires the zstandard "
+            "package").format(path))
+
+    if fileobj is None:
+        f = codec.open(path, mode + 'b')
+    elif kind == 'gz':
+        f = codec.GzipFile(path, mode + 'b', fileobj=fileobj)
+    else:
+        f = codec.open(fileobj, mode + 'b')
+
+    if mode == 'r':
+        return io.BufferedReader(f, BUFFER_SIZE)
+    return io.BufferedWriter(f, BUFFER_SIZE)
+
+
+def parse(path):
+    """
+    Parses the, possibly compressed, XML file at **path** and returns the
+    :class:`etree.ElementTree`.  Anything which isn't a local file is passed
+    to the XML library's parse as is.
+    """
+    backend = get_backend()
+
+    try:
+        kind = compression_of(path)
+    except OSError:
+        # Not a local file (lxml also takes URLs), leave it to the library.
+        kind = None
+
+    if kind is None:
+        # Let the XML library read the file itself.
+        return backend.parse(path)
+
+    with open_xml(path) as f:
+        return backend.parse(f)
+
+
+def write(tree, path, atomic=False, **write_kwargs):
+    """
+    Writes the :class:`etree.ElementTree` **tree** to **path**, compressing
+    it if the extension calls for it.  **write_kwargs** are passed on to
+    :func:`etree.ElementTree.write`, see :func:`~__init__.EtreeBackend.write`.
+
+    **atomic**
+        If True, the file is written under a temporary name in the same
+        directory and renamed to **path** once complete, so readers never
+        see a partial file and a failed write leaves any existing file
+        untouched.  The new file gets the permissions of the file it
+        replaces, or if there is none, those a plain write would give it.
+    """
+    backend = get_backend()
+    kind = compression_of(path, 'w')
+
+    if not atomic:
+        if kind is None:
+            backend.write(tree, path, **write_kwargs)
+        else:
+            with _open(path, 'w', kind) as f:
+                backend.write(tree, f, **write_kwargs)
+        return
+
+    tmp_path = _create_temp(path)
+    try:
+        with open(tmp_path, 'wb', buffering=BUFFER_SIZE) as f:
+            if kind is None:
+                backend.write(tree, f, **write_kwargs)
+            else:
+                # Through the open file, so that gzip records the name of
+                # path rather than the temporary one.
+                with _open(path, 'w', kind, f) as compressed:
+                    backend.write(tree, compressed, **write_kwargs)
+        try:
+            mode = stat.S_IMODE(os.stat(path).st_mode)
+        except OSError:
+            pass
+        else:
+            os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _create_temp(path):
+    """
+    Creates an empty file with a unique name next to **path**, and returns
+    its path.  Unlike :func:`tempfile.mkstemp`, which makes the file
+    private, this creates it as open() would, so the process umask applies
+    without having to be read (which can only be done by changing it).
+    """
+    directory, name = os.path.split(path)
+    while True:
+        tmp_path = os.path.join(directory, '.{}.{}.tmp'.format(
+            name, os.urandom(4).hex()))
+        try:
+            fd = os.open(
+                tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        except FileExistsError:
+            continue
+        os.close(fd)
+        return tmp_path